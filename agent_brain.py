@@ -1,23 +1,1135 @@
+import atexit
+import hashlib
+import io
+import json
 import os
-import google.generativeai as genai
+import pickle
+import random
+import re
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import llm_cache
 
 # 1. 설정 (Secrets에서 가져오기)
-api_key = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=api_key)
+API_KEY = os.environ.get("GEMINI_API_KEY")
+DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL")
+
+@dataclass(frozen=True)
+class AgentConfig:
+    """과거에 파일 복사본마다 흩어져 있던 설정들을 한 곳에 모은 것. 환경변수로 조정."""
+
+    # 404 에러를 방지하기 위해 가장 안정적인 모델명을 앞에 두고, 죽어 있으면 뒤로 폴백
+    models_to_try: tuple = ("gemini-1.5-flash", "gemini-1.5-pro", "gemini-pro", "gemini-1.0-pro")
+    fallback_order: tuple = ("gemini", "openai", "anthropic")
+    temperature: float = 0.7
+    retry_base: float = 1.0
+    retry_cap: float = 60.0
+    max_attempts: int = 3
+
+    @classmethod
+    def from_env(cls):
+        kwargs = {}
+        if os.environ.get("NIGHTLY_MODELS"):
+            kwargs["models_to_try"] = tuple(m.strip() for m in os.environ["NIGHTLY_MODELS"].split(",") if m.strip())
+        if os.environ.get("LLM_FALLBACK_ORDER"):
+            kwargs["fallback_order"] = tuple(n.strip() for n in os.environ["LLM_FALLBACK_ORDER"].split(",") if n.strip())
+        if os.environ.get("NIGHTLY_TEMPERATURE"):
+            kwargs["temperature"] = float(os.environ["NIGHTLY_TEMPERATURE"])
+        return cls(**kwargs)
+
+
+CONFIG = AgentConfig.from_env()
+MODELS_TO_TRY = list(CONFIG.models_to_try)
+MODEL_NAME = MODELS_TO_TRY[0]
+
+
+def api_url(model):
+    return f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={API_KEY}"
+
+
+def stream_url(model):
+    return f"https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse&key={API_KEY}"
+
+# 2. 연결 풀링: 호출마다 TCP+TLS 핸드셰이크를 새로 하지 않도록 세션을 재사용
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive", "Content-Type": "application/json"})
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)
+SESSION.mount("https://", _adapter)
+SESSION.mount("http://", _adapter)
+atexit.register(SESSION.close)
+
+# httpx(+h2)가 설치돼 있으면 일반 생성 호출은 HTTP/2로: 병렬 턴들이 한 연결을
+# 멀티플렉싱하고 반복 헤더는 HPACK으로 압축된다. 없으면 requests 세션 그대로.
+# 스트리밍(SSE)과 웹훅은 requests 경로를 유지한다.
+try:
+    import httpx
+    HTTPX_CLIENT = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=4, keepalive_expiry=85),
+        timeout=60,
+    )
+    atexit.register(HTTPX_CLIENT.close)
+    TRANSPORT_ERRORS = (requests.RequestException, httpx.HTTPError)
+except ImportError:
+    HTTPX_CLIENT = None
+    TRANSPORT_ERRORS = (requests.RequestException,)
+
+# 3. 응답 캐시는 llm_cache 모듈로 분리 (같은 조합이면 API를 다시 부르지 않음)
+CACHE_DIR = llm_cache.CACHE_DIR
+
+
+# 재시도: AWS 스타일 full-jitter 지수 백오프 (고정 sleep은 thundering-herd 유발)
+RETRY_BASE = CONFIG.retry_base
+RETRY_CAP = CONFIG.retry_cap
+MAX_ATTEMPTS = CONFIG.max_attempts
+
+# 일시적 장애로 보고 재시도/다음 프로바이더로 넘어갈 상태 코드
+RECOVERABLE_STATUS = {429, 500, 503}
+
+# 우리 쪽 요청 자체가 잘못된 경우: 어떤 모델/프로바이더로 보내도 똑같이 실패하므로
+# 폴백하지 말고 즉시 올린다 (400=InvalidArgument). 401/403은 자격 증명 문제라
+# 다른 프로바이더(다른 키)로는 넘어가되 같은 프로바이더 안에서는 재시도하지 않는다.
+FAIL_FAST_STATUS = {400}
+CREDENTIAL_STATUS = {401, 403}
+
+
+def _status_of(exc):
+    """전송 예외에서 HTTP 상태 코드를 꺼낸다. 타임아웃 등 응답이 없으면 None."""
+    resp = getattr(exc, "response", None)
+    return getattr(resp, "status_code", None)
+
+# 같은 런 안에서 연속 N번 실패한 프로바이더는 더 이상 시도하지 않음 (서킷 브레이커)
+CIRCUIT_BREAK_AFTER = 3
+
+
+def backoff_delay(attempt, base=RETRY_BASE, cap=RETRY_CAP):
+    """attempt번째 재시도 전 대기 시간 (0 ~ min(cap, base*2^attempt) 균등 분포)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+# 오류 유형별 재시도 정책: (최대 시도 횟수, 기본 지연, 지연 상한).
+# 429는 할당량 회복을 기다릴 가치가 있어 끈질기게, 대신 상한을 30초로 묶어
+# 대기 시간이 수백 초로 폭주하지 않게 한다. None 키는 응답 자체가 없는
+# 전송 오류(타임아웃, 연결 끊김)용.
+RETRY_POLICY = {
+    429: (5, 2.0, 30.0),
+    500: (3, 1.0, 15.0),
+    503: (3, 1.0, 15.0),
+    None: (MAX_ATTEMPTS, RETRY_BASE, 15.0),
+}
+
+
+def post_with_retry(url, payload, headers=None):
+    """재시도 루프를 공유하는 POST 헬퍼. 최종 실패 시 예외를 던진다."""
+    attempt = 0
+    while True:
+        try:
+            if HTTPX_CLIENT is not None:
+                response = HTTPX_CLIENT.post(url, json=payload, headers=headers)
+            else:
+                response = SESSION.post(url, json=payload, headers=headers, timeout=60)
+            response.raise_for_status()
+            return response.json()
+        except TRANSPORT_ERRORS as e:
+            resp = getattr(e, "response", None)
+            status = getattr(resp, "status_code", None)
+            # 4xx류(키 오류, 잘못된 요청)는 재시도해도 소용없으니 바로 포기
+            if resp is not None and status not in RECOVERABLE_STATUS:
+                raise
+            max_retries, base, cap = RETRY_POLICY.get(status, RETRY_POLICY[None])
+            if attempt >= max_retries - 1:
+                raise
+            delay = backoff_delay(attempt, base, cap)
+            # 서버가 Retry-After를 주면 그 값을 우선
+            if resp is not None:
+                delay = max(float(resp.headers.get("Retry-After", 0)), delay)
+            print(f"⚠️ API 호출 실패 ({e}), {delay:.1f}초 후 재시도...")
+            time.sleep(delay)
+            attempt += 1
+
+
+# 명시적 컨텍스트 캐시: 시스템 프롬프트 + 저장소 컨텍스트는 턴 2~4에서 그대로
+# 재전송되므로, 서버 쪽에 캐시해 두면 프리픽스 토큰이 크게 할인되고 TTFT도 준다.
+CONTEXT_CACHE_NAME = None
+
+
+def create_context_cache(system_prompt, repo_context, ttl_minutes=10):
+    """Gemini cachedContents 리소스를 만들고 이름을 반환. 실패하면 None.
+
+    캐시 최소 토큰(2048) 미만이면 서버가 400을 주는데, 그 경우에는 그냥
+    캐시 없이 평소처럼 프롬프트에 인라인으로 싣는다.
+    """
+    url = f"https://generativelanguage.googleapis.com/v1beta/cachedContents?key={API_KEY}"
+    payload = {
+        "model": f"models/{MODEL_NAME}",
+        "systemInstruction": {"parts": [{"text": system_prompt}]},
+        "contents": [{"role": "user", "parts": [{"text": repo_context}]}],
+        "ttl": f"{ttl_minutes * 60}s",
+    }
+    try:
+        response = SESSION.post(url, json=payload, timeout=30)
+        response.raise_for_status()
+        return response.json().get("name")
+    except requests.RequestException as e:
+        print(f"ℹ️ 컨텍스트 캐시 생성 불가 ({e}) - 인라인 컨텍스트로 진행")
+        return None
+
+
+def delete_context_cache(name):
+    try:
+        SESSION.delete(f"https://generativelanguage.googleapis.com/v1beta/{name}?key={API_KEY}", timeout=30)
+    except requests.RequestException:
+        pass
+
+
+# 모델별 생존 기록. 매 런마다 죽은 모델에 404 네 번을 순서대로 맞지 않도록
+# 최근 성공 순으로 정렬하고, 10분 내에 3연속 실패한 모델은 건너뛴다.
+HEALTH_FILE = os.path.join(CACHE_DIR, "model_health.json")
+HEALTH_SKIP_FAILS = 3
+HEALTH_SKIP_WINDOW = 600  # 초
+
+
+def load_model_health():
+    try:
+        with open(HEALTH_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_model_health(registry):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(HEALTH_FILE, "w", encoding="utf-8") as f:
+        json.dump(registry, f)
+
+
+def rank_models(registry):
+    """시도할 모델을 최근 성공 순으로 정렬하고, 방금 죽은 모델은 제외한다."""
+    now = time.time()
+    ranked = sorted(MODELS_TO_TRY, key=lambda m: -registry.get(m, {}).get("last_ok", 0))
+    alive = [
+        m for m in ranked
+        if not (registry.get(m, {}).get("consecutive_fails", 0) >= HEALTH_SKIP_FAILS
+                and now - registry.get(m, {}).get("last_fail", 0) < HEALTH_SKIP_WINDOW)
+    ]
+    # 전부 서킷이 열려 있으면 그래도 1순위는 시도해 본다
+    return alive or ranked[:1]
+
+
+def mark_model(registry, model, ok):
+    entry = registry.setdefault(model, {"consecutive_fails": 0})
+    if ok:
+        entry["last_ok"] = time.time()
+        entry["consecutive_fails"] = 0
+    else:
+        entry["last_fail"] = time.time()
+        entry["consecutive_fails"] = entry.get("consecutive_fails", 0) + 1
+
+
+class Provider:
+    """LLM 프로바이더 공통 인터페이스. messages는 Gemini 형식을 공용으로 쓴다."""
+
+    name = "base"
+
+    def __init__(self):
+        self.consecutive_fails = 0
+
+    def available(self):
+        return False
+
+    def generate(self, messages, temperature):
+        raise NotImplementedError
+
+
+class GeminiProvider(Provider):
+    name = "gemini"
+
+    def available(self):
+        return bool(API_KEY)
+
+    def generate(self, messages, temperature):
+        payload = {
+            "contents": messages,
+            "generationConfig": {"temperature": temperature},
+        }
+        registry = load_model_health()
+        last_error = None
+        try:
+            for model in rank_models(registry):
+                # 컨텍스트 캐시는 MODEL_NAME 전용 리소스라, 다른 모델 payload에
+                # 실으면 400(fail-fast)으로 폴백 전체가 죽는다
+                if CONTEXT_CACHE_NAME and model == MODEL_NAME:
+                    payload["cachedContent"] = CONTEXT_CACHE_NAME
+                else:
+                    payload.pop("cachedContent", None)
+                try:
+                    data = post_with_retry(api_url(model), payload)
+                    mark_model(registry, model, ok=True)
+                    return data["candidates"][0]["content"]["parts"][0]["text"]
+                except TRANSPORT_ERRORS as e:
+                    mark_model(registry, model, ok=False)
+                    # 요청/키 문제는 어느 모델로 보내도 똑같으니 모델 순회 중단
+                    if _status_of(e) in FAIL_FAST_STATUS | CREDENTIAL_STATUS:
+                        raise
+                    last_error = e
+                    print(f"⚠️ 모델 {model} 실패, 다음 모델 시도")
+            raise last_error
+        finally:
+            save_model_health(registry)
+
+
+def _flatten(messages):
+    """Gemini 형식 messages를 OpenAI/Anthropic용 role+content 목록으로 변환"""
+    out = []
+    for m in messages:
+        text = "\n".join(p["text"] for p in m["parts"])
+        role = "assistant" if m["role"] == "model" else "user"
+        out.append({"role": role, "content": text})
+    return out
+
+
+class OpenAIProvider(Provider):
+    name = "openai"
+
+    def __init__(self):
+        super().__init__()
+        self.api_key = os.environ.get("OPENAI_API_KEY")
+
+    def available(self):
+        return bool(self.api_key)
+
+    def generate(self, messages, temperature):
+        payload = {
+            "model": "gpt-4o-mini",
+            "messages": _flatten(messages),
+            "temperature": temperature,
+        }
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        data = post_with_retry("https://api.openai.com/v1/chat/completions", payload, headers)
+        return data["choices"][0]["message"]["content"]
+
+
+class AnthropicProvider(Provider):
+    name = "anthropic"
+
+    def __init__(self):
+        super().__init__()
+        self.api_key = os.environ.get("ANTHROPIC_API_KEY")
+
+    def available(self):
+        return bool(self.api_key)
+
+    def generate(self, messages, temperature):
+        payload = {
+            "model": "claude-3-5-haiku-latest",
+            "max_tokens": 8192,
+            "messages": _flatten(messages),
+            "temperature": temperature,
+        }
+        headers = {"x-api-key": self.api_key, "anthropic-version": "2023-06-01"}
+        data = post_with_retry("https://api.anthropic.com/v1/messages", payload, headers)
+        return data["content"][0]["text"]
+
+
+_PROVIDER_CLASSES = {
+    "gemini": GeminiProvider,
+    "openai": OpenAIProvider,
+    "anthropic": AnthropicProvider,
+}
+
+# 폴백 순서는 환경변수로 조정 가능 (예: LLM_FALLBACK_ORDER="openai,gemini")
+PROVIDERS = [_PROVIDER_CLASSES[n]() for n in CONFIG.fallback_order if n in _PROVIDER_CLASSES]
+
+
+def chat_with_gemini(messages, temperature=CONFIG.temperature, cacheable=False):
+    """프로바이더 체인을 순회하며 LLM 호출 (Gemini가 기본, 장애 시 폴백)
+
+    cacheable=True이고 temperature가 0이면 .agent_cache에서 먼저 찾아보고,
+    히트하면 API 호출을 통째로 생략한다.
+    """
+    use_cache = cacheable and temperature <= 0
+    if use_cache:
+        key = llm_cache.cache_key(MODEL_NAME, messages, temperature)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            print("♻️ 캐시 히트 - API 호출 생략")
+            return cached
+
+    last_error = None
+    for provider in PROVIDERS:
+        if not provider.available():
+            continue
+        if provider.consecutive_fails >= CIRCUIT_BREAK_AFTER:
+            continue  # 이 런에서는 죽은 프로바이더 건너뜀
+        try:
+            text = provider.generate(messages, temperature)
+            provider.consecutive_fails = 0
+            if use_cache:
+                llm_cache.set(key, text)
+            return text
+        except TRANSPORT_ERRORS as e:
+            provider.consecutive_fails += 1
+            # 잘못된 요청(400)은 폴백해도 똑같이 실패하므로 즉시 올린다.
+            # 자격 증명 오류(401/403)는 키가 다른 다음 프로바이더로는 넘어간다.
+            if _status_of(e) in FAIL_FAST_STATUS:
+                raise
+            last_error = e
+            print(f"⚠️ {provider.name} 실패 ({e}), 다음 프로바이더로 폴백")
+    raise last_error if last_error else RuntimeError("사용 가능한 LLM 프로바이더가 없습니다")
+
+
+def send_discord(msg):
+    """디스코드 웹훅으로 결과 알림 (같은 SESSION 재사용)"""
+    if not DISCORD_WEBHOOK_URL:
+        return
+    try:
+        # (연결 3초, 읽기 5초): 웹훅이 느려도 잡을 전체 잡아먹지 않게
+        SESSION.post(DISCORD_WEBHOOK_URL, json={"content": msg}, timeout=(3, 5))
+    except requests.RequestException as e:
+        print(f"⚠️ Discord 전송 실패: {e}")
+
+
+# 런 사이에 유지되는 에이전트 메모리 (저장소 해시 등)
+MEMORY_FILE = "agent_memory.json"
+
+
+def load_memory():
+    try:
+        with open(MEMORY_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_memory(memory):
+    # 임시 파일에 쓴 뒤 os.replace로 원자적 교체: 도중에 죽어도 기존 파일이 안 깨짐
+    tmp = MEMORY_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(memory, f, separators=(",", ":"), ensure_ascii=False)
+    os.replace(tmp, MEMORY_FILE)
+
+
+# 대화 히스토리 영속화: 저장소 해시가 같은 재실행(실패 후 재시도 등)은 지난
+# 히스토리에서 이어가므로, 정적 프리픽스를 다시 만들어 보낼 필요가 없다
+def _history_cache_path(ctx_hash):
+    return os.path.join(CACHE_DIR, f"history_{ctx_hash[:16]}.pkl")
+
+
+def load_history_cache(ctx_hash):
+    try:
+        with open(_history_cache_path(ctx_hash), "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return None
+
+
+def save_history_cache(ctx_hash, history):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(_history_cache_path(ctx_hash), "wb") as f:
+        pickle.dump(history, f)
+
+
+def list_models_cached():
+    """사용 가능한 모델 목록 (진단용). 24시간 디스크 캐시로 API 왕복을 아낀다."""
+    path = os.path.join(CACHE_DIR, "models.json")
+    try:
+        if time.time() - os.path.getmtime(path) < 86400:
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+    except OSError:
+        pass
+    url = f"https://generativelanguage.googleapis.com/v1beta/models?key={API_KEY}"
+    data = SESSION.get(url, timeout=30).json()
+    models = [
+        m["name"] for m in data.get("models", [])
+        if "generateContent" in m.get("supportedGenerationMethods", [])
+    ]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(models, f)
+    return models
+
+
+# 날짜 문자열은 임포트 시 한 번만 포맷 (푸시 커밋 메시지와 브랜치명이 공유)
+TODAY = datetime.now().strftime("%Y-%m-%d")
+TODAY_BRANCH = f"nightly-{TODAY}"
+
+# 커밋 작성자 정보는 config를 두 번 호출하는 대신 -c 인라인 옵션으로 전달
+GIT_IDENTITY = ["-c", "user.name=Nightly AI", "-c", "user.email=ai@nightly.com"]
+
+# 출력을 검사하지 않는 subprocess 호출용: 파이프 할당/복사 없이 바로 버린다
+_QUIET = {"stdout": subprocess.DEVNULL, "stderr": subprocess.DEVNULL}
+
+
+LAST_HEAD_FILE = os.path.join(CACHE_DIR, "last_head")
+
+
+def _current_head():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, timeout=10).strip()
+    except (subprocess.SubprocessError, OSError):
+        return None
+
+
+def repo_unchanged_since_last_run():
+    """지난 '성공' 런 이후 새 커밋이 없으면 True. 가장 싼 LLM 호출은 하지 않는 호출이다.
+
+    여기서는 비교만 한다. HEAD 기록은 런이 끝까지 간 뒤 record_last_head()가
+    하므로, 도중에 죽은 런이 다음 재시도까지 빠른 경로로 잠궈 버리지 않는다.
+    """
+    head = _current_head()
+    if head is None:
+        return False
+    try:
+        with open(LAST_HEAD_FILE, encoding="utf-8") as f:
+            return f.read().strip() == head
+    except OSError:
+        return False
+
+
+def record_last_head():
+    """성공적으로 끝난 런의 HEAD를 기록한다 (빠른 경로의 비교 기준)."""
+    head = _current_head()
+    if head is None:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(LAST_HEAD_FILE, "w", encoding="utf-8") as f:
+        f.write(head)
+
+
+def setup_git_branch():
+    """오늘자 작업 브랜치 생성 (config x2 + checkout 세 번 대신 git 한 번 호출)
+
+    -B는 브랜치가 이미 있으면 재설정하므로 같은 날 재실행해도 폴백 checkout이
+    필요 없다. 출력은 검사하지 않으니 파이프 없이 DEVNULL로 버린다.
+    """
+    try:
+        subprocess.run(
+            ["git", *GIT_IDENTITY, "checkout", "-B", TODAY_BRANCH],
+            **_QUIET, timeout=30, check=True,
+        )
+    except subprocess.TimeoutExpired:
+        send_discord("⚠️ git checkout이 멈춤 - 잡 중단")
+        raise
+
+
+def push_changes():
+    """변경 사항이 있으면 커밋하고 푸시한다.
+
+    add → 변경 검사 → commit → push를 셸 한 번으로 묶어 프로세스 생성을
+    4회에서 1회로 줄인다. porcelain 출력을 캡처하는 대신
+    `git diff --cached --quiet`의 종료 코드로 빈 스테이징을 판별한다.
+    반환값은 "pushed"(푸시됨) / "clean"(변경 없음) / "failed"(거부됨) 중 하나:
+    푸시가 이 에이전트의 유일한 산출물이므로 실패를 '변경 없음'과
+    구분해 위로 올려야 한다.
+    """
+    script = (
+        "git add . && "
+        "if git diff --cached --quiet; then exit 3; fi && "
+        "git -c 'user.name=Nightly AI' -c user.email=ai@nightly.com "
+        f"commit -m '🤖 Nightly update {TODAY}' && "
+        f"git push origin {TODAY_BRANCH}"
+    )
+    try:
+        # 네트워크가 끼는 push까지 포함하므로 로컬 git(30초)보다 넉넉하게.
+        # stdout은 버리되 stderr는 남긴다: 종료 코드만으로는 push가 왜
+        # 거부됐는지(인증, non-fast-forward) 알 수 없어서다.
+        result = subprocess.run(["bash", "-c", script], stdout=subprocess.DEVNULL, timeout=120)
+    except subprocess.TimeoutExpired:
+        send_discord("⚠️ git push가 멈춤 - 잡 중단")
+        raise
+    if result.returncode == 3:
+        print("ℹ️ 변경 사항 없음 - 푸시 생략")
+        return "clean"
+    if result.returncode != 0:
+        print(f"❌ git push 실패 (rc={result.returncode}) - stderr 로그 확인")
+        return "failed"
+    return "pushed"
+
+
+def _file_sha1(path):
+    """파일 내용 해시. 큰 스크린샷을 통째로 복사하지 않도록 mmap으로 읽는다."""
+    import mmap
+    with open(path, "rb") as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha1(mm).hexdigest()
+        except ValueError:  # 빈 파일은 mmap 불가
+            return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_visual_context(memory):
+    """루트의 스크린샷(png/jpg)을 올려 file_data 파트 목록을 돌려준다.
+
+    반환된 파트는 과제 user 턴의 parts에 그대로 덧붙일 수 있다. 업로드 핸들은
+    48시간 유효하므로, 내용 해시가 같으면 지난 런의 uri를 재사용해 업로드
+    왕복(장당 1~3초)을 생략한다. 매핑은 agent_memory.json에 보관.
+    """
+    names = sorted(
+        n for n in os.listdir(".")
+        if n.lower().endswith((".png", ".jpg", ".jpeg"))
+    )
+    if not names:
+        return []
+    # 업로드에만 SDK를 쓰므로, 없으면 스크린샷 없이 진행 (httpx와 같은 취급)
+    try:
+        import google.generativeai as genai
+    except ImportError:
+        print("ℹ️ google-generativeai 미설치 - 스크린샷 첨부 생략")
+        return []
+    genai.configure(api_key=API_KEY)
+    cache = memory.setdefault("upload_cache", {})
+    parts = []
+    for name in names:
+        key = _file_sha1(name)
+        entry = cache.get(key)
+        # 구형식 항목(uri 없이 name만 저장)은 그냥 다시 올린다
+        if not entry or "uri" not in entry or entry["expires"] <= time.time():
+            uploaded = genai.upload_file(name)
+            entry = {
+                "uri": uploaded.uri,
+                "mime": uploaded.mime_type,
+                "expires": time.time() + 48 * 3600,
+            }
+            cache[key] = entry
+        parts.append({"file_data": {"file_uri": entry["uri"], "mime_type": entry["mime"]}})
+    return parts
+
+
+# 수리 프롬프트에 실어 보낼 실패 로그 정리용 패턴
+ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
+FAILURE_RE = re.compile(r"(FAILED .*?)(?=\n=+|\Z)", re.DOTALL)
+FAILURE_LOG_LIMIT = 4000
+FAILURE_LOG_MAX_SECTIONS = 5
+
+
+def compact_failure_log(log):
+    """pytest 로그에서 실패 섹션만 추려 모델에 보낼 크기로 줄인다.
+
+    전체 트레이스백은 수만 자까지 가서 입력 토큰과 프리픽스 캐시를 둘 다
+    망가뜨리므로, ANSI 이스케이프를 벗기고 FAILED 섹션 최대 5개 / 4000자로 자른다.
+    """
+    log = ANSI_RE.sub("", log)
+    failures = FAILURE_RE.findall(log)
+    if failures:
+        log = "\n".join(failures[:FAILURE_LOG_MAX_SECTIONS])
+    return log[:FAILURE_LOG_LIMIT]
+
+
+def _pytest_args():
+    """수리 루프에 맞춘 pytest 인자: 첫 실패에서 끊고, 군더더기 출력과 플러그인은 끈다."""
+    args = ["-x", "-q", "--no-header", "-p", "no:cacheprovider"]
+    import importlib.util
+    if importlib.util.find_spec("xdist"):
+        args += ["-n", "auto"]  # 멀티코어 분산 실행
+    if importlib.util.find_spec("pytest_timeout"):
+        args += ["--timeout=60"]  # 생성된 코드의 무한 루프 방지
+    return args
+
+
+# 에이전트 자신의 모듈은 테스트 사이에 내리면 안 된다
+_KEEP_MODULES = {"agent_brain", "llm_cache", "__main__"}
+
+
+def _purge_local_modules():
+    """작업 트리에서 임포트된 모듈을 sys.modules에서 내린다.
+
+    수리 루프가 파일을 고쳐 쓴 뒤의 인프로세스 재실행이 묵은 바이트코드를
+    보지 않게 하기 위한 조치다.
+    """
+    cwd = os.getcwd() + os.sep
+    for name, mod in list(sys.modules.items()):
+        path = getattr(mod, "__file__", None)
+        if name not in _KEEP_MODULES and path and os.path.abspath(path).startswith(cwd):
+            del sys.modules[name]
+
+
+class _ThreadTee(io.TextIOBase):
+    """생성한 스레드의 출력만 버퍼로 모으고, 다른 스레드는 원래 스트림으로 보낸다.
+
+    redirect_stdout은 sys.stdout을 프로세스 전역으로 바꾸기 때문에, 테스트와
+    동시에 도는 프라이머 LLM 호출의 경고 출력까지 pytest 로그에 섞여
+    수리 프롬프트를 오염시킨다. 스레드 id로 라우팅해 그걸 막는다.
+    """
+
+    def __init__(self, fallback, buf):
+        self.fallback = fallback
+        self.buf = buf
+        self.owner = threading.get_ident()
+
+    def write(self, s):
+        target = self.buf if threading.get_ident() == self.owner else self.fallback
+        return target.write(s)
+
+    def flush(self):
+        self.fallback.flush()
+
+
+def run_tests():
+    """pytest를 인프로세스로 돌려 (통과 여부, 로그)를 반환한다.
+
+    subprocess로 새 인터프리터를 띄우면 시작+재임포트에 0.5~2초가 드는데,
+    pytest.main은 그 비용이 없다. 캐시 플러그인은 이미 꺼져 있다.
+    출력 캡처는 이 스레드로 한정한다 (_ThreadTee 참고). pytest의 기본 fd 캡처는
+    fd 1/2 자체를 가로채므로, 다른 스레드의 출력은 미리 복제해 둔 원래 fd로
+    내보내야 pytest 로그에 섞이지 않는다.
+    """
+    import pytest
+
+    _purge_local_modules()
+    buf = io.StringIO()
+    old_out, old_err = sys.stdout, sys.stderr
+    try:
+        fallback = os.fdopen(os.dup(old_out.fileno()), "w", encoding="utf-8")
+    except (OSError, io.UnsupportedOperation, AttributeError):
+        fallback = old_out  # fd가 없는 스트림(테스트 등)이면 그대로 쓴다
+    sys.stdout = _ThreadTee(fallback, buf)
+    sys.stderr = _ThreadTee(fallback, buf)
+    try:
+        rc = pytest.main(_pytest_args())
+    finally:
+        sys.stdout, sys.stderr = old_out, old_err
+        if fallback is not old_out:
+            fallback.close()
+    # 종료 코드 5(수집된 테스트 없음)는 실패가 아니다: 테스트 없는 밤에
+    # '테스트가 실패했어'라며 빈 로그로 수리 루프를 돌고 잡까지 1로 끝내는
+    # 것을 막는다. 고칠 게 없으니 통과로 취급한다.
+    if rc == 5:
+        print("ℹ️ 수집된 테스트 없음 - 통과로 간주")
+        return True, buf.getvalue()
+    return rc == 0, buf.getvalue()
+
+
+# 저장소 순회 시 건너뛸 디렉토리/파일. frozenset이라 멤버십 검사가 O(1)
+IGNORE_DIRS = frozenset({
+    ".git", "__pycache__", "node_modules", ".venv", ".agent_cache",
+    ".pytest_cache", ".mypy_cache", "dist", "build",
+})
+IGNORE_SUFFIXES = (".pyc", ".pyo", ".png", ".jpg", ".jpeg", ".gif", ".ico", ".lock")
+PREVIEW_BYTES = 300
+MAX_FILES = 500
+MAX_PREVIEW_SIZE = 1 << 20  # 1MB 넘는 파일은 미리보기 생략
+PREVIEW_BUDGET = 64 << 10  # 미리보기 총량 상한 (프롬프트 토큰 폭주 방지)
+PREVIEW_SUFFIXES = (".py", ".md", ".txt")
+
+
+# 밤 사이 대부분의 파일은 안 바뀌므로, 미리보기를 (mtime, size) 키로 캐시해
+# 다음 런에서는 디스크 읽기 없이 재사용한다
+PREVIEW_CACHE_FILE = os.path.join(CACHE_DIR, "preview.pkl")
+
+
+def _load_preview_cache():
+    try:
+        with open(PREVIEW_CACHE_FILE, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.PickleError, EOFError):
+        return {}
+
+
+def _save_preview_cache(cache):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(PREVIEW_CACHE_FILE, "wb") as f:
+        pickle.dump(cache, f)
+
+
+def read_repository_structure():
+    """os.scandir로 저장소 구조를 훑어 LLM에게 줄 컨텍스트 문자열을 만든다.
+
+    문자열 += 누적(O(N^2)) 대신 리스트에 모아 한 번에 join하고,
+    미리보기는 파일 앞 300바이트만 읽는다. 인메모리 메모이제이션은 하지
+    않는다: 루트 디렉토리 mtime은 하위 디렉토리 안의 쓰기에 반응하지 않아
+    키로 못 쓰고, 미리보기 캐시가 파일별 (mtime, size)로 디스크 읽기를
+    이미 아껴 준다.
+    """
+    parts = ["Current Project Structure:"]
+    count = 0
+    preview_spent = 0
+    old_previews = _load_preview_cache()
+    new_previews = {}
+
+    # 재귀 대신 명시적 스택: 깊은 트리에서도 재귀 한도/프레임 할당이 없다.
+    # is_dir(follow_symlinks=False)는 readdir의 dtype을 재사용해 추가 stat을 피하고,
+    # 심링크는 루프 방지를 위해 통째로 건너뛴다.
+    stack = ["."]
+    while stack and count < MAX_FILES:
+        d = stack.pop()
+        with os.scandir(d) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        subdirs = []
+        for e in entries:
+            if e.name in IGNORE_DIRS or e.is_symlink():
+                continue
+            if e.is_dir(follow_symlinks=False):
+                subdirs.append(e.path)
+                continue
+            if e.name.endswith(IGNORE_SUFFIXES):
+                continue
+            if count >= MAX_FILES:
+                break
+            count += 1
+            # 경로 구분자를 /로 통일해 런/플랫폼 간 문자열이 흔들리지 않게 한다
+            parts.append(f"- {e.path.replace(os.sep, '/')}")
+            # 미리보기는 앞 300바이트만, 전체 예산(64KB)을 다 쓰면 경로만 나열
+            st = e.stat()
+            if (e.name.endswith(PREVIEW_SUFFIXES)
+                    and preview_spent < PREVIEW_BUDGET
+                    and st.st_size <= MAX_PREVIEW_SIZE):
+                cache_id = (st.st_mtime_ns, st.st_size)
+                cached = old_previews.get(e.path)
+                if cached is not None and cached[0] == cache_id:
+                    preview = cached[1]
+                else:
+                    try:
+                        with open(e.path, "rb") as f:
+                            preview = f.read(PREVIEW_BYTES).decode("utf-8", "ignore")
+                        preview = preview.rstrip()
+                    except OSError:
+                        continue
+                new_previews[e.path] = (cache_id, preview)
+                preview_spent += len(preview)
+                parts.append(f"  (Preview): {preview}")
+        # pop()이 뒤에서 꺼내므로 역순으로 쌓아야 정렬 순서대로 방문한다
+        stack.extend(reversed(subdirs))
+
+    # 삭제된 파일의 항목은 자연히 떨어져 나간다
+    _save_preview_cache(new_previews)
+    body = "\n".join(parts)
+    # 끝에 지문을 달아 두면 캐시 키 계산이 전체 문자열 대신 이 한 줄로도 가능
+    fingerprint = hashlib.sha256(body.encode()).hexdigest()
+    return f"{body}\n(fingerprint: sha256={fingerprint[:16]})"
+
+
+# 응답에서 파일 블록을 뽑아내는 패턴. 호출마다 다시 컴파일하지 않도록 모듈 스코프에 한 번만.
+# 경로는 [^\n]+로 줄 끝까지 고정해 잘린 응답에서도 백트래킹이 번지지 않게 한다.
+FILE_BLOCK_RE = re.compile(r"### FILE: ([^\n]+)\n```(?:\w+)?\n(.*?)```", re.DOTALL)
+
+
+def _safe_path(file_path):
+    """모델이 준 경로 검증: 절대 경로나 .. 탈출은 거부하고 None을 돌려준다."""
+    path = os.path.normpath(file_path.strip())
+    if os.path.isabs(path) or ".." in path.split(os.sep):
+        print(f"🚫 안전하지 않은 경로 무시: {file_path.strip()!r}")
+        return None
+    return path
+
+
+def _write_one(match):
+    file_path, code_content = match
+    # 임시 파일 + os.replace: 중간에 죽어도 반쯤 쓰인 파일이 남지 않는다
+    tmp = file_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8", buffering=1 << 16) as f:
+        f.write(code_content.strip() + "\n")
+    os.replace(tmp, file_path)
+    print(f"💾 저장: {file_path}")
+    return file_path
+
+
+def extract_and_save_code(response_text):
+    """응답에서 `### FILE:` 블록을 찾아 파일로 저장하고, 저장한 경로 목록을 돌려준다."""
+    # finditer: 매치 리스트를 통째로 만들지 않고 스트리밍으로 순회
+    matches = [
+        (path, m.group(2))
+        for m in FILE_BLOCK_RE.finditer(response_text)
+        if (path := _safe_path(m.group(1))) is not None
+    ]
+    if not matches:
+        return []
+    # 같은 디렉토리에 makedirs를 반복 호출하지 않도록 먼저 중복 제거
+    # (최상위 파일은 dirname이 ""라서 makedirs가 터지므로 "."로 보정)
+    dirs = {os.path.dirname(p) or "." for p, _ in matches}
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        return list(ex.map(_write_one, matches))
+
+
+def chat_with_gemini_stream(messages, temperature=CONFIG.temperature, cacheable=False):
+    """스트리밍 호출: 생성 도중 완성된 FILE 블록을 즉시 저장해 디스크 I/O를 겹친다.
+
+    Gemini 외 프로바이더로 폴백해야 하거나 스트림이 끊기면 일반 경로로 돌아간다.
+    전체 응답 텍스트를 반환하며, FILE 블록 저장은 이 함수 안에서 끝난다.
+    chat_with_gemini와 같은 조건(cacheable이고 temperature<=0)으로 응답 캐시를
+    쓰며, 히트 시에는 캐시된 텍스트에서 파일을 저장하고 API를 부르지 않는다.
+    """
+    use_cache = cacheable and temperature <= 0
+    if use_cache:
+        key = llm_cache.cache_key(MODEL_NAME, messages, temperature)
+        cached = llm_cache.get(key)
+        if cached is not None:
+            print("♻️ 캐시 히트 - API 호출 생략")
+            extract_and_save_code(cached)
+            return cached
+    payload = {
+        "contents": messages,
+        "generationConfig": {"temperature": temperature},
+    }
+    if CONTEXT_CACHE_NAME:
+        payload["cachedContent"] = CONTEXT_CACHE_NAME
+    chunks = []
+    buffer = ""
+    made_dirs = set()
+    try:
+        with SESSION.post(stream_url(MODEL_NAME), json=payload, timeout=120, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                try:
+                    piece = json.loads(data)["candidates"][0]["content"]["parts"][0]["text"]
+                except (ValueError, KeyError, IndexError):
+                    continue
+                chunks.append(piece)
+                buffer += piece
+                # 닫는 ```가 도착한 블록은 생성이 끝나기를 기다리지 않고 바로 저장
+                while (m := FILE_BLOCK_RE.search(buffer)):
+                    path = _safe_path(m.group(1))
+                    if path is not None:
+                        # 같은 디렉토리에 makedirs(경로 성분마다 stat)를 반복하지 않음
+                        dir_name = os.path.dirname(path) or "."
+                        if dir_name not in made_dirs:
+                            os.makedirs(dir_name, exist_ok=True)
+                            made_dirs.add(dir_name)
+                        _write_one((path, m.group(2)))
+                    buffer = buffer[m.end():]
+    except requests.RequestException as e:
+        print(f"⚠️ 스트리밍 실패 ({e}), 일반 호출로 재시도")
+        # 폴백 경로의 캐시 저장은 chat_with_gemini가 알아서 한다
+        text = chat_with_gemini(messages, temperature, cacheable=cacheable)
+        extract_and_save_code(text)
+        return text
+    text = "".join(chunks)
+    if use_cache:
+        llm_cache.set(key, text)
+    return text
+
+
+# dedent+strip은 임포트 시 한 번만 수행된다. 들여쓰기/가장자리 공백이 매 턴
+# 입력 토큰으로 새지 않게 하고, 편집하다 프롬프트가 안으로 밀려도 안전하다.
+SYSTEM_PROMPT = textwrap.dedent("""\
+    너는 매일 밤 이 프로젝트를 한 단계씩 발전시키는 시니어 개발자 AI다.
+    코드를 생성할 때는 반드시 아래 형식을 지켜라:
+
+    ### FILE: path/to/file.py
+    ```python
+    (파일 전체 내용)
+    ```
+    """).strip()
+
+
+def user_turn(text):
+    return {"role": "user", "parts": [{"text": text}]}
+
+
+def model_turn(text):
+    return {"role": "model", "parts": [{"text": text}]}
+
+
+# 히스토리는 매 호출마다 통째로 재전송되므로(Gemini는 상태가 없다) 한도를 넘으면 접는다
+HISTORY_BYTE_LIMIT = 20_000
+
+
+def _history_has_context(history):
+    """저장된 히스토리 안에 전체 저장소 컨텍스트가 실려 있는지.
+
+    컨텍스트 캐시 브랜치에서 저장된 히스토리는 컨텍스트가 서버 캐시에만
+    있었으므로, 여기서 걸러내지 않으면 스텁만 들고 재개하게 된다.
+    """
+    return any(
+        "[Repo Context]" in part.get("text", "")
+        for turn in history
+        for part in turn["parts"]
+    )
+
+
+def trim_history(history):
+    """히스토리가 한도를 넘으면 오래된 턴들을 로컬 요약으로 접는다.
+
+    마지막 2턴은 그대로 두어 직전 맥락이 끊기지 않게 한다. 요약은 추가 API
+    호출 없이 각 턴의 머리 부분을 불릿으로 딴다. 접을 턴이 없으면(히스토리가
+    이미 2턴 이하) 그대로 반환한다 - 빈 요약 턴을 앞세우면 페이로드만 커진다.
+    요약은 별도 턴이 아니라 남겨 둔 첫 user 턴의 텍스트 앞에 접어 넣는다:
+    요약을 user 턴으로 앞세우면 user-user 연속이 생기는데, 역할 교대가 깨진
+    대화는 Anthropic 폴백이 400으로 거부하고(400은 FAIL_FAST라 폴백 없이
+    런이 죽는다), Gemini도 user 우선 교대를 기대한다.
+    """
+    if len(history) <= 2 or len(json.dumps(history, ensure_ascii=False)) <= HISTORY_BYTE_LIMIT:
+        return history
+    old, tail = history[:-2], history[-2:]
+    bullets = []
+    for turn in old:
+        text = " ".join(p.get("text", "(첨부)") for p in turn["parts"])
+        bullets.append(f"- ({turn['role']}) {text[:200]}")
+    summary = "지금까지의 턴 요약:\n" + "\n".join(bullets)
+    head, rest = tail[0], tail[1:]
+    if head["role"] != "user":
+        # 교대 히스토리에서는 올 수 없는 모양이지만, 그래도 user 우선은 지킨다
+        return [user_turn(summary)] + tail
+    new_parts = list(head["parts"])
+    for i, part in enumerate(new_parts):
+        if "text" in part:
+            new_parts[i] = {"text": summary + "\n\n" + part["text"]}
+            break
+    else:  # 텍스트 파트가 없으면(첨부만) 요약을 새 파트로 앞에 둔다
+        new_parts.insert(0, {"text": summary})
+    return [{"role": "user", "parts": new_parts}] + rest
+
+
+def _warm_repair_cache(primer):
+    """수리 턴 대비 프리픽스 캐시 워밍업. 결과는 버리고 실패도 무시한다."""
+    try:
+        chat_with_gemini(primer)
+    except Exception as e:
+        print(f"ℹ️ 프라이머 워밍업 실패 (무시): {e}")
+
 
 def main():
     print("🚀 Nightly Agent Started (Robust Mode)")
-    
-    # 404 에러를 방지하기 위해 가장 안정적인 모델명 사용
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    
-    try:
-        # 에러가 나던 chat_with_gemini 대신 최신 방식 사용
-        response = model.generate_content("안녕? 오늘 날씨에 어울리는 맥퀸의 컬렉션을 추천해줘.")
-        print(f"✅ Gemini Response: {response.text}")
+
+    # 모델 목록 조회는 로직에 쓰이지 않는 진단 출력이므로 명시적으로 켤 때만
+    if os.environ.get("DEBUG_LIST_MODELS"):
+        for name in list_models_cached():
+            print(f"  - {name}")
+
+    # 조용한 밤 빠른 경로: HEAD가 지난 런과 같으면 파이프라인 전체를 건너뛴다
+    if repo_unchanged_since_last_run():
+        print("ℹ️ 지난 런 이후 변경 없음 - 오늘 밤은 쉬어감")
+        send_discord("ℹ️ Nightly Agent: 변경 없음, 실행 생략")
+        return 0
+
+    setup_git_branch()
+
+    # 푸시 전용 워커: 결과 회수를 맨 끝까지 미루기 위해 with 블록을 쓰지 않는다
+    push_executor = ThreadPoolExecutor(max_workers=1)
+    push_fut = None
+    push_status = None
+    exit_code = 1
+    try:
+        # Step 1: 계획 수립 (저장소 구조를 컨텍스트로 제공)
+        memory = load_memory()
+        repo_context = read_repository_structure()
+        ctx_hash = hashlib.sha256(repo_context.encode()).hexdigest()
+        memory["repo_ctx_hash"] = ctx_hash
+
+        # 정적인 부분(시스템 프롬프트 + 저장소 컨텍스트)은 서버 쪽에 캐시 시도.
+        # 성공하면 각 턴에는 동적인 과제 텍스트만 싣는다. 캐시에는 항상 '전체'
+        # 컨텍스트를 넣는다 - 해시 스텁은 모델이 이미 전체 컨텍스트를 받은
+        # 경로(아래 히스토리 재개)에서만 안전하다.
+        global CONTEXT_CACHE_NAME
+        CONTEXT_CACHE_NAME = create_context_cache(SYSTEM_PROMPT, repo_context)
+        # 계획/코드/문서는 서로의 모델 출력에 의존하지 않으므로 세 턴을 하나로
+        # 융합한다: 왕복 3회 → 1회 (수리 턴만 실패 시 추가로 나간다).
+        # 히스토리 재전송분의 입력 토큰도 함께 사라진다.
+        fused_task = (
+            "오늘 밤 프로젝트를 한 단계 발전시켜줘. 한 번의 응답에 다음을 모두 담아줘:\n"
+            "1) docs/PLAN.md - 오늘의 계획\n"
+            "2) 계획을 구현하는 소스 코드와 tests/ 아래 테스트\n"
+            "3) 변경을 반영한 README.md\n"
+            "모든 파일은 반드시 ### FILE: 형식으로."
+        )
+        # 루트에 스크린샷이 있으면 업로드 핸들을 과제 턴에 file_data로 첨부
+        visual_parts = get_visual_context(memory)
+        prior_history = load_history_cache(ctx_hash)
+        if (prior_history is not None and not CONTEXT_CACHE_NAME
+                and not _history_has_context(prior_history)):
+            # 이 히스토리의 컨텍스트는 지난 런의 서버 캐시에만 있었고 그 캐시는
+            # 이미 지워졌다. 이대로 이어가면 모델이 저장소를 모른 채 작업하므로
+            # 재개를 포기하고 전체 컨텍스트 경로로 내려간다.
+            prior_history = None
+        if prior_history is not None:
+            # 같은 저장소 상태의 지난 히스토리에서 이어가기 (trim_history가 크기를 막아줌).
+            # 전체 컨텍스트는 히스토리(또는 서버 캐시)에 이미 있으므로 스텁만 더한다.
+            print("♻️ 지난 히스토리에서 이어감")
+            task_turn = user_turn(f"(저장소 구조는 지난 런과 동일, sha={ctx_hash[:12]})\n\n" + fused_task)
+            history = prior_history + [task_turn]
+        elif CONTEXT_CACHE_NAME:
+            print("✅ 컨텍스트 캐시 사용")
+            task_turn = user_turn(fused_task)
+            history = [task_turn]
+        else:
+            # 명시적 캐시가 없어도, 정적 내용(페르소나+출력 형식+저장소 컨텍스트)을
+            # 프롬프트 맨 앞에 / 동적 과제를 맨 뒤에 두면 암시적 프리픽스 캐싱이
+            # 공유 구간을 알아서 할인한다
+            static_prefix = SYSTEM_PROMPT + "\n\n[Repo Context]\n" + repo_context
+            task_turn = user_turn(static_prefix + "\n\n[Task]\n" + fused_task)
+            history = [task_turn]
+        task_turn["parts"] += visual_parts
+
+        # 융합 턴은 스트리밍으로 받아 파일 저장을 생성과 겹친다
+        res1 = chat_with_gemini_stream(history)
+        print("✅ Step 1 (Plan+Code+Docs) 완료")
+        history.append(model_turn(res1))
+        history = trim_history(history)
+
+        # pytest가 도는 동안(10~30초) 수리용 프라이밍 호출을 미리 보내
+        # 모델 쪽 프리픽스 캐시를 덥혀 둔다 (통과하면 결과는 버림).
+        # 데몬 스레드라 green path가 프라이머 생성 완료를 기다리지 않는다 -
+        # with ThreadPoolExecutor는 __exit__에서 join하므로 빠르게 통과한
+        # 밤마다 버릴 응답 한 번 분량의 대기가 붙는 역효과가 있었다.
+        primer = history + [user_turn("방금 작성한 코드의 테스트가 실패할 수 있어. 수정할 준비를 해줘.")]
+        threading.Thread(target=_warm_repair_cache, args=(primer,), daemon=True).start()
+        passed, log = run_tests()
+
+        if not passed:
+            print("🔧 테스트 실패 - 수리 시도")
+            fix_history = history + [user_turn(f"테스트가 실패했어. 로그를 보고 코드를 고쳐줘:\n{compact_failure_log(log)}")]
+            # 수리 턴도 스트리밍: 고쳐진 파일이 생성 도중에 바로 저장된다.
+            # 수리는 창의성보다 재현성이 중요하므로 temperature 0으로 내리고,
+            # 같은 실패 로그로 다시 돌면 응답 캐시가 API 호출을 통째로 아낀다.
+            fix_text = chat_with_gemini_stream(fix_history, temperature=0, cacheable=True)
+            # 모델이 파일을 하나도 안 고쳤으면 재실행해 봐야 같은 실패다
+            if FILE_BLOCK_RE.search(fix_text):
+                passed, log = run_tests()
+            else:
+                print("ℹ️ 수리 턴에 파일 블록 없음 - 재테스트 생략")
+        print("✅ 테스트 통과" if passed else "⚠️ 테스트 실패 상태로 마무리")
+
+        save_history_cache(ctx_hash, history)
+        save_memory(memory)
+        record_last_head()
+
+        # 푸시 뒤에는 아무것도 의존하지 않으므로 백그라운드로 띄워만 두고,
+        # Discord 알림과 캐시 정리가 도는 동안 네트워크 왕복(1~5초)을 숨긴다.
+        # 결과는 맨 마지막(finally)에 한 번만 회수한다.
+        push_fut = push_executor.submit(push_changes)
+        send_discord(f"✅ Nightly Agent 완료\n계획: {res1[:500]}")
+        # Actions가 후속 스텝을 끊을 수 있도록 테스트 결과를 종료 코드로 전달
+        exit_code = 0 if passed else 1
     except Exception as e:
         print(f"❌ Error: {e}")
+        send_discord(f"❌ Nightly Agent 실패: {e}")
         raise e
+    finally:
+        if CONTEXT_CACHE_NAME:
+            delete_context_cache(CONTEXT_CACHE_NAME)
+        if push_fut is not None:
+            push_status = push_fut.result()
+            if push_status == "pushed":
+                print("✅ 푸시 완료")
+            elif push_status == "clean":
+                print("ℹ️ 푸시할 변경 없음")
+        push_executor.shutdown()
+
+    # 푸시 거부(인증, non-fast-forward)는 결과물이 원격에 없다는 뜻이므로
+    # '변경 없음'과 달리 알림을 쏘고 잡을 실패로 끝낸다
+    if push_status == "failed":
+        send_discord("❌ Nightly Agent: git push 거부됨 - 결과가 원격에 반영되지 않음")
+        return 1
+    return exit_code
+
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
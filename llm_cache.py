@@ -0,0 +1,39 @@
+"""LLM 응답 파일 캐시.
+
+밤마다 반복되는 결정적(temperature<=0) 호출은 같은 응답을 돌려주므로,
+(모델, 메시지, 온도)를 SHA-256으로 키 삼아 .agent_cache/{key}.json에
+저장해 두고 TTL 안에서는 API를 다시 부르지 않는다.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+CACHE_DIR = ".agent_cache"
+DEFAULT_TTL = 24 * 3600  # 24시간
+
+
+def cache_key(model, messages, temp):
+    blob = json.dumps({"m": model, "msgs": messages, "t": temp}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+
+def get(key, ttl=DEFAULT_TTL):
+    """키에 해당하는 캐시 응답. 없거나 TTL이 지났으면 None."""
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if time.time() - cached["ts"] < ttl:
+            return cached["text"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def set(key, text):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"ts": time.time(), "text": text}, f, ensure_ascii=False)